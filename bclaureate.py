@@ -398,16 +398,24 @@ class Run(object):
         # clusters must exist at one of pre-defined "wells", which are in the
         # same locations on each tile, i.e. one locs file for whole run
         # placed in root/Data/Intensities/
+        # one well per cluster, so the header agrees with the payload and
+        # with the cluster count of every tile's .bcl and .filter files
         total_clusters = PARAMS["clusters"]
+        x_wells = int(math.ceil(math.sqrt(total_clusters)))
+        y_wells = int(math.ceil(total_clusters / float(x_wells)))
         x_locs = [struct.pack("<f", x) for x in
                         sorted([(random.uniform(0, PARAMS["dims"]["width"]))
-                              for xloc in range(total_clusters / 3)])]
+                              for xloc in range(x_wells)])]
         y_locs = [struct.pack("<f", float(y)) for y in
                         sorted([(random.uniform(0, PARAMS["dims"]["height"]))
-                              for yloc in range(2 * total_clusters / 3)])]
+                              for yloc in range(y_wells)])]
         cluster_locs = ""
+        c = 0
         for xloc in x_locs:
             for yloc in y_locs:
+                if c == total_clusters:
+                    break
+                c += 1
                 cluster_locs += xloc
                 cluster_locs += yloc
 
@@ -484,7 +492,7 @@ class Run(object):
                                 cluster_locs += struct.pack("<f",
                                     random.uniform(0, PARAMS["dims"]["width"]))
                                 cluster_locs += struct.pack("<f",
-                                    random.uniform(0, PARAMS["dims"]["width"]))
+                                    random.uniform(0, PARAMS["dims"]["height"]))
                             # bytes 8-11: unsigned int num_clusters
                             s += struct.pack("<I", c)
                             # bytes 12-end: float x_coord; float y_coord
@@ -0,0 +1,421 @@
+#!/usr/bin/python2.7
+
+from __future__ import print_function
+import os
+import sys
+import getopt
+import mmap
+import math
+import zlib
+import struct
+from array import array
+from xml.etree import ElementTree
+
+import bclaureate
+
+# Reads back a run directory written by bclaureate.py and checks that every
+# .bcl(.gz/.bgzf), .bci, .filter, .locs and .clocs file is well formed and
+# that cluster counts agree with each other and with RunInfo.xml.
+#
+# Uncompressed files are memory-mapped and payloads are checked with
+# whole-buffer operations (array, bytes.translate, min/max) rather than
+# per-cluster struct calls, so a full-size run validates much faster than
+# it is generated.
+
+# valid byte values; anything left after deleting these is invalid
+FILTER_VALID = b"\x00\x01"
+# .clocs coordinates are in tenths of a pixel within a 25px bin
+CLOCS_BIN_SIZE = 25.0
+CLOCS_VALID = bytes(bytearray(range(int(10 * CLOCS_BIN_SIZE))))
+# the generator always lays .clocs bins over a 2048px wide image
+CLOCS_NUM_BINS = int(math.ceil(2048 / CLOCS_BIN_SIZE)) * 5
+
+
+class Layout(object):
+    def __init__(self, path):
+        root = ElementTree.parse(os.path.join(path, "RunInfo.xml")).getroot()
+        run = root.find("Run")
+        instrument = root.findtext("Instrument")
+        self.machinetype = None
+        for machinetype, name in bclaureate.machinenames.items():
+            if name == instrument:
+                self.machinetype = machinetype
+        if self.machinetype is None:
+            raise ValueError("unknown instrument {}".format(instrument))
+
+        flowcell = run.find("FlowcellLayout")
+        self.lanes = int(flowcell.get("LaneCount"))
+        self.surfaces = int(flowcell.get("SurfaceCount"))
+        self.swaths = int(flowcell.get("SwathCount"))
+        self.tiles = int(flowcell.get("TileCount"))
+        self.sections = int(flowcell.get("SectionPerLane", 1))
+
+        self.cycles = sum(int(read.get("NumCycles"))
+                          for read in run.find("Reads").findall("Read"))
+
+        # miseq and hiseq2500 RunInfo.xml carry no image dimensions
+        dims = run.find("ImageDimensions")
+        if dims is not None:
+            self.width = float(dims.get("Width"))
+            self.height = float(dims.get("Height"))
+        else:
+            self.width = float(bclaureate.PARAMS["dims"]["width"])
+            self.height = float(bclaureate.PARAMS["dims"]["height"])
+
+    def tile_names(self, lane_idx):
+        # names as used in per-tile file names, in the order the generator
+        # writes them (section, swath, surface, tile)
+        names = []
+        for section_idx in range(self.sections):
+            for swath_idx in range(self.swaths):
+                for surface_idx in range(self.surfaces):
+                    for tile_idx in range(self.tiles):
+                        if self.machinetype == "nextseq":
+                            section_offset = 1 if lane_idx < 2 else 4
+                            names.append("{:d}{:d}{:d}{:02d}".format(
+                                surface_idx + 1,
+                                swath_idx + 1,
+                                section_idx + section_offset,
+                                tile_idx + 1))
+                        else:
+                            name = "{:d}{:d}{:02d}".format(
+                                surface_idx + 1,
+                                swath_idx + 1,
+                                tile_idx + 1)
+                            # without sections, the generator writes the
+                            # same tile once per section
+                            if name not in names:
+                                names.append(name)
+        return names
+
+
+class Validator(object):
+    def __init__(self, path):
+        self.path = path
+        self.errors = []
+        self.files = 0
+        self.layout = Layout(path)
+
+    def error(self, path, message):
+        self.errors.append("{}: {}".format(
+            os.path.relpath(path, self.path), message))
+
+    def bcpath(self, lane_idx):
+        return os.path.join(self.path, "Data", "Intensities", "BaseCalls",
+                            "L{:03d}".format(lane_idx + 1))
+
+    def bclpath(self, lane_idx, cycle_idx, name):
+        if self.layout.machinetype == "nextseq":
+            return os.path.join(self.bcpath(lane_idx),
+                                "{:04d}.bcl.bgzf".format(cycle_idx))
+        return os.path.join(self.bcpath(lane_idx),
+                            "C{:d}.1".format(cycle_idx),
+                            "s_{:d}_{}.bcl.gz".format(lane_idx + 1, name))
+
+    def locspath(self, lane_idx):
+        return os.path.join(self.path, "Data", "Intensities",
+                            "L{:03d}".format(lane_idx + 1))
+
+    def _open(self, path):
+        # returns a read-only memory map of path, or None if the file is
+        # missing or empty (which mmap cannot map)
+        if not os.path.isfile(path):
+            self.error(path, "missing")
+            return None
+        self.files += 1
+        if os.path.getsize(path) == 0:
+            self.error(path, "empty")
+            return None
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _open_gz(self, path):
+        # gzip and bgzf files are both concatenated gzip members
+        m = self._open(path)
+        if m is None:
+            return None
+        try:
+            chunks = []
+            data = m[:]
+            while data:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                chunks.append(d.decompress(data))
+                data = d.unused_data
+                # only the last member can be cut off mid-stream
+                if not data and not member_ended(d):
+                    self.error(path, "truncated gzip member")
+                    return None
+                chunks.append(d.flush())
+            return b"".join(chunks)
+        except zlib.error as e:
+            self.error(path, "corrupt gzip stream ({})".format(e))
+            return None
+        finally:
+            m.close()
+
+    def check_bcl(self, path):
+        # bytes 0-3: unsigned int num_clusters; then one byte per cluster
+        data = self._open_gz(path)
+        if data is None:
+            return None
+        if len(data) < 4:
+            self.error(path, "shorter than header")
+            return None
+        (n,) = struct.unpack_from("<I", data)
+        if n != len(data) - 4:
+            self.error(path, "header gives {:d} clusters, payload has {:d}"
+                             .format(n, len(data) - 4))
+        return n
+
+    def check_bcls(self, lane_idx, tile_names):
+        # returns cluster count per tile (or per lane for nextseq), taken
+        # from the first cycle and checked against every other cycle
+        counts = {}
+        if self.layout.machinetype == "nextseq":
+            tile_names = [None]
+        for cycle_idx in range(1, self.layout.cycles + 1):
+            for name in tile_names:
+                path = self.bclpath(lane_idx, cycle_idx, name)
+                n = self.check_bcl(path)
+                if n is None:
+                    continue
+                if name not in counts:
+                    counts[name] = n
+                elif counts[name] != n:
+                    self.error(path, "{:d} clusters, earlier cycles have {:d}"
+                                     .format(n, counts[name]))
+        return counts
+
+    def check_bci(self, path, tile_names, clusters):
+        # repeated (unsigned int tile_number, unsigned int num_clusters)
+        m = self._open(path)
+        if m is None:
+            return
+        try:
+            if len(m) % 8:
+                self.error(path, "size {:d} is not a multiple of 8"
+                                 .format(len(m)))
+                return
+            records = array("I", m[:])
+            if sys.byteorder == "big":
+                records.byteswap()
+            tiles = records[0::2].tolist()
+            counts = records[1::2]
+            expected = [int(name) for name in tile_names]
+            if tiles != expected:
+                self.error(path, "tile numbers do not match RunInfo.xml")
+            if clusters is not None and sum(counts) != clusters:
+                self.error(path, "tiles sum to {:d} clusters, bcl has {:d}"
+                                 .format(sum(counts), clusters))
+        finally:
+            m.close()
+
+    def check_filter(self, path, clusters):
+        # bytes 0-3: 0; bytes 4-7: version (3); bytes 8-11: num_clusters;
+        # then one byte per cluster, 1 if it passed filter else 0
+        m = self._open(path)
+        if m is None:
+            return
+        try:
+            if len(m) < 12:
+                self.error(path, "shorter than header")
+                return
+            zero, version, n = struct.unpack_from("<III", m)
+            if zero != 0 or version != 3:
+                self.error(path, "bad header ({:d}, {:d})"
+                                 .format(zero, version))
+            payload = m[12:]
+            if n != len(payload):
+                self.error(path, "header gives {:d} clusters, payload has {:d}"
+                                 .format(n, len(payload)))
+            if payload.translate(None, FILTER_VALID):
+                self.error(path, "values other than 0 and 1")
+            if clusters is not None and n != clusters:
+                self.error(path, "{:d} clusters, bcl has {:d}"
+                                 .format(n, clusters))
+        finally:
+            m.close()
+
+    def check_locs(self, path, clusters):
+        # bytes 0-3: 1; bytes 4-7: float 1.0; bytes 8-11: num_clusters;
+        # then float x, float y per cluster. Returns num_clusters from the
+        # header.
+        m = self._open(path)
+        if m is None:
+            return None
+        try:
+            if len(m) < 12:
+                self.error(path, "shorter than header")
+                return None
+            version, one, n = struct.unpack_from("<IfI", m)
+            if version != 1 or one != 1.0:
+                self.error(path, "bad header ({:d}, {})".format(version, one))
+            if (len(m) - 12) % 8:
+                self.error(path, "payload is not a whole number of "
+                                 "coordinate pairs")
+                return n
+            coords = array("f", m[12:])
+            if sys.byteorder == "big":
+                coords.byteswap()
+            if n != len(coords) // 2:
+                self.error(path, "header gives {:d} clusters, payload has {:d}"
+                                 .format(n, len(coords) // 2))
+            if clusters is not None and len(coords) // 2 != clusters:
+                self.error(path, "{:d} clusters, bcl has {:d}"
+                                 .format(len(coords) // 2, clusters))
+            if coords:
+                if not in_range(coords[0::2], self.layout.width):
+                    self.error(path, "x coordinates outside image width "
+                                     "{:g}".format(self.layout.width))
+                if not in_range(coords[1::2], self.layout.height):
+                    self.error(path, "y coordinates outside image height "
+                                     "{:g}".format(self.layout.height))
+            return n
+        finally:
+            m.close()
+
+    def check_clocs(self, path, clusters):
+        # byte 0: version (1); bytes 1-4: unsigned int num_bins; then per
+        # bin one byte num_clusters followed by (byte x, byte y) per cluster
+        m = self._open(path)
+        if m is None:
+            return
+        try:
+            if len(m) < 5:
+                self.error(path, "shorter than header")
+                return
+            version, num_bins = struct.unpack_from("<BI", m)
+            if version != 1:
+                self.error(path, "bad version {:d}".format(version))
+            if num_bins != CLOCS_NUM_BINS:
+                self.error(path, "{:d} bins, expected {:d}"
+                                 .format(num_bins, CLOCS_NUM_BINS))
+            data = bytearray(m[5:])
+            offset = 0
+            total = 0
+            outside = False
+            b = 0
+            while b < num_bins:
+                if offset >= len(data) or \
+                        offset + 1 + 2 * data[offset] > len(data):
+                    self.error(path, "truncated at bin {:d}".format(b))
+                    return
+                n = data[offset]
+                if data[offset + 1:offset + 1 + 2 * n].translate(
+                        None, CLOCS_VALID):
+                    outside = True
+                offset += 1 + 2 * n
+                total += n
+                b += 1
+            if offset != len(data):
+                self.error(path, "{:d} bytes past last bin"
+                                 .format(len(data) - offset))
+            if outside:
+                self.error(path, "coordinates outside bin")
+            if clusters is not None and total != clusters:
+                self.error(path, "{:d} clusters, bcl has {:d}"
+                                 .format(total, clusters))
+        finally:
+            m.close()
+
+    def _validate_nextseq(self, lane_idx, tile_names):
+        clusters = self.check_bcls(lane_idx, tile_names).get(None)
+        self.check_bci(os.path.join(self.bcpath(lane_idx),
+                                    "s_{:d}.bci".format(lane_idx + 1)),
+                       tile_names, clusters)
+        self.check_filter(os.path.join(self.bcpath(lane_idx),
+                                       "s_{:d}.filter".format(lane_idx + 1)),
+                          clusters)
+        self.check_locs(os.path.join(self.locspath(lane_idx),
+                                     "s_{:d}.locs".format(lane_idx + 1)),
+                        clusters)
+
+    def _validate_hiseqx(self, lane_idx, tile_names):
+        counts = self.check_bcls(lane_idx, tile_names)
+        for name in tile_names:
+            clusters = counts.get(name)
+            self.check_filter(os.path.join(self.bcpath(lane_idx),
+                              "s_{:d}_{}.filter".format(lane_idx + 1, name)),
+                              clusters)
+            tile_locs = "s_{:d}_{}".format(lane_idx + 1, name)
+            if self.layout.machinetype == "miseq":
+                self.check_locs(os.path.join(self.locspath(lane_idx),
+                                             tile_locs + ".locs"), clusters)
+            elif self.layout.machinetype == "hiseq2500":
+                self.check_clocs(os.path.join(self.locspath(lane_idx),
+                                              tile_locs + ".clocs"), clusters)
+        return counts
+
+    def _validate_patterned(self, counts):
+        # patterned flowcells share one set of wells across all tiles, so
+        # every tile must have exactly as many clusters as s.locs has wells
+        path = os.path.join(self.path, "Data", "Intensities", "s.locs")
+        wells = self.check_locs(path, None)
+        if len(set(counts.values())) > 1:
+            self.error(path, "tiles disagree on cluster count ({})".format(
+                ", ".join(str(n) for n in sorted(set(counts.values())))))
+        if wells is None:
+            return
+        for (lane_idx, name), n in sorted(counts.items()):
+            if n != wells:
+                self.error(self.bclpath(lane_idx, 1, name),
+                           "{:d} clusters, s.locs has {:d} wells"
+                           .format(n, wells))
+
+    def validate(self):
+        counts = {}
+        for lane_idx in range(self.layout.lanes):
+            tile_names = self.layout.tile_names(lane_idx)
+            if self.layout.machinetype == "nextseq":
+                self._validate_nextseq(lane_idx, tile_names)
+            else:
+                tile_counts = self._validate_hiseqx(lane_idx, tile_names)
+                for name, n in tile_counts.items():
+                    counts[(lane_idx, name)] = n
+        if self.layout.machinetype in ("hiseqx", "hiseq4000"):
+            self._validate_patterned(counts)
+        return not self.errors
+
+
+def member_ended(d):
+    # whether decompressobj d has read a whole gzip member, trailer included
+    if hasattr(d, "eof"):
+        return d.eof
+    # python 2.7 has no eof flag, but once a member has ended any further
+    # input is passed straight through to unused_data
+    try:
+        d.decompress(b"\0")
+    except zlib.error:
+        return False
+    return d.unused_data == b"\0"
+
+
+def in_range(values, upper):
+    # NaN fails every comparison, so catch it through the sum
+    total = sum(values)
+    return total == total and 0 <= min(values) and max(values) <= upper
+
+
+def usage():
+    print("Usage:")
+    print(" $ ./bclvalidate.py <run directory>")
+    sys.exit(2)
+
+
+def main(argv):
+    try:
+        opts, args = getopt.gnu_getopt(argv, "", [])
+    except getopt.GetoptError:
+        usage()
+    if len(args) != 1:
+        usage()
+    validator = Validator(args[0])
+    ok = validator.validate()
+    for error in validator.errors:
+        print(error)
+    print("Checked {:d} files for {} run: {:d} errors".format(
+        validator.files, validator.layout.machinetype, len(validator.errors)))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])